@@ -126,7 +126,7 @@ class AdditiveAgent(Agent):
 
     def is_EF1(self, my_bundle_or_value, other_bundle:Bundle):
         if len(other_bundle)==0: return True
-        best_item_in_other_bundle = max([self.values[item] for item in other_bundle])
+        best_item_in_other_bundle = max([self.item_value(item) for item in other_bundle])
         my_value = self.value(my_bundle_or_value) if isinstance(my_bundle_or_value,(list,set,str)) else my_bundle_or_value
         return my_value >= self.value(other_bundle)-best_item_in_other_bundle
 
@@ -153,6 +153,10 @@ class AdditiveAgentWithCapacity(AdditiveAgent):
     True
     >>> Alice.is_saturated({'x','O'})
     False
+    >>> Alice.is_EF1({'x'}, {'y','z','w'})
+    False
+    >>> Alice.is_EF1({'x','y'}, {'z','w'})
+    True
     """
 
     def __init__(self, capacity:int, values:Dict[Item,float], name:str=None):
@@ -172,6 +176,14 @@ class AdditiveAgentWithCapacity(AdditiveAgent):
         """
         return self.num_items_in_bundle(items) >= self.capacity
 
+    def is_EF1(self, my_bundle_or_value, other_bundle:Bundle):
+        """
+        The value of a bundle is not additive, so the value of the other bundle minus each item is computed explicitly.
+        """
+        if len(other_bundle)==0: return True
+        my_value = self.value(my_bundle_or_value) if isinstance(my_bundle_or_value,(list,set,str)) else my_bundle_or_value
+        return my_value >= min([self.value([other for other in other_bundle if other!=item]) for item in other_bundle])
+
     def __repr__(self):
         return super().__repr__() + " and capacity "+str(self.capacity)
 
@@ -196,6 +208,8 @@ class AdditiveAgentWithCategoryCapacities(AdditiveAgent):
     13
     >>> Alice.value({'ax','ay','az','bx','by','bz'})
     16
+    >>> Alice.item_value('bz')
+    7
     >>> Alice.all_items()
     ['ax', 'ay', 'az', 'aw', 'bx', 'by', 'bz', 'bw']
     >>> Alice.best_category_item_in_bundle({'ax','ay','az','bx','bz'}, 0)
@@ -210,6 +224,11 @@ class AdditiveAgentWithCategoryCapacities(AdditiveAgent):
     True
     >>> Alice.is_saturated({'ax','by'}, 1)
     False
+    >>> Bob = AdditiveAgentWithCategoryCapacities([(1,{'ax':9,'ay':8}),(1,{'bx':1})], "Bob")
+    >>> Bob.is_EF1({'bx'}, {'ax','ay'})
+    False
+    >>> Bob.is_EF1({'ax'}, {'ay','bx'})
+    True
     """
 
     def __init__(self, categories:List[Category], name:str=None):
@@ -224,6 +243,14 @@ class AdditiveAgentWithCategoryCapacities(AdditiveAgent):
         """
         return sum ([sub_agent.value(items) for sub_agent in self.sub_agents])
 
+    def item_value(self, item:Item)->float:
+        """
+        Return the value of a single item (ignoring the capacities).
+        """
+        return sum([sub_agent.item_value(item) for sub_agent in self.sub_agents])
+
+    is_EF1 = AdditiveAgentWithCapacity.is_EF1   # the capacities make the value non-additive in the same way.
+
     def category_items(self, category_index:int):
         return self.categories[category_index][1]
 
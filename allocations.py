@@ -12,6 +12,7 @@ Bundle = Set[Item]
 Allocation = List[Bundle]
 
 from agents import Agent
+from feasibility import Constraint, CompiledConstraint, BundleState
 
 
 def feasible_allocations(all_items:Bundle, num_of_agents:int, is_feasible:Callable[[Bundle,Item], bool]):
@@ -65,9 +66,12 @@ class AllocationEnumerator:
         :param num_of_agents: How many bundles should be in each allocation. For example 3.
         :param is_feasible: a function that accepts a bundle and a potential item to add to it,
                and returns True iff the new bundle (bundle+item) is feasible.
+               It can also be a declarative Constraint (from feasibility.py); it is then compiled for the given items.
         NOTE: The feasibility constraint must be downwards-closed, so that if a bundle is feasible, all its subsets are feasible too.
               An empty bundle is always feasible.
         """
+        if isinstance(is_feasible, Constraint):
+            is_feasible = is_feasible.compile(sorted(list(all_items)))
         self.all_items = sorted(list(all_items))
         self.num_of_agents = num_of_agents
         self.num_of_items = len(all_items)
@@ -158,10 +162,49 @@ class AllocationEnumerator:
         {y},{z},{x}
         {z},{y},{x}
         """
+        if isinstance(self.is_feasible, CompiledConstraint):
+            yield from self.feasible_allocations_with_compiled_constraint()
+            return
         initial_allocation = [{}]*self.num_of_agents
         first_item_index = 0
         yield from self.feasible_allocations_starting_at_index(initial_allocation, first_item_index)
 
+    def feasible_allocations_with_compiled_constraint(self):
+        """
+        Generates all feasible allocations, when is_feasible is a CompiledConstraint.
+        Each bundle is represented by its compiled state, so each feasibility check takes a few integer operations.
+        The allocations are generated in the same order as in feasible_allocations.
+
+        >>> from feasibility import *
+        >>> ae = AllocationEnumerator({'x','y','z'}, 2, Cardinality(2) & Conflicts([('x','y')]))
+        >>> for a in ae.feasible_allocations():
+        ...     print(stringify_allocation(a))
+        {x,z},{y}
+        {x},{y,z}
+        {y,z},{x}
+        {y},{x,z}
+        """
+        constraint = self.is_feasible
+        item_indices = [constraint.index[item] for item in self.all_items]
+        num_of_agents = self.num_of_agents
+
+        def allocations_starting_at_index(states:List[BundleState], first_new_item_index:int):
+            item_index = item_indices[first_new_item_index]
+            next_new_item_index = first_new_item_index+1
+            for i in range(num_of_agents):
+                if constraint.can_add(states[i], item_index):
+                    new_states = list(states)
+                    new_states[i] = constraint.add(states[i], item_index)
+                    if next_new_item_index<self.num_of_items:
+                        yield from allocations_starting_at_index(new_states, next_new_item_index)
+                    else:
+                        yield [set(constraint.items_of(state)) for state in new_states]
+
+        if self.num_of_items==0:
+            yield [set() for _ in range(num_of_agents)]
+            return
+        yield from allocations_starting_at_index([constraint.initial_state()]*num_of_agents, 0)
+
 
 
 
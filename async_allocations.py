@@ -0,0 +1,394 @@
+"""
+Asynchronous streaming versions of the allocation enumerators, for use inside an asyncio event loop.
+
+The search runs in a worker thread (or a worker process), and batches of allocations are streamed back
+through a bounded queue: when the consumer is slow, the worker waits (backpressure).
+When the consumer stops iterating (e.g. because a client disconnected), the worker is stopped.
+
+Also defines a small in-process JSON-lines server, for exercising the API end to end.
+
+Author: Erel Segal-Halevi
+Since:  2020-08
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import multiprocessing
+import queue
+import threading
+
+from typing import *
+Item = Any
+Bundle = Set[Item]
+Allocation = List[Bundle]
+
+from agents import AdditiveAgent
+from allocations import feasible_allocations
+from cycle_free_allocations import cycle_free_allocations
+from fairness import is_EF1
+from feasibility import everything_is_feasible, at_most_1_item_per_agent, at_most_3_items_per_agent
+
+_BATCH, _ERROR, _DONE = "batch", "error", "done"
+POLL_INTERVAL = 0.05   # seconds between checks of the stop flag while a worker waits.
+WORKER_JOIN_TIMEOUT = 1   # seconds to wait for a worker to stop; a worker process is then terminated.
+WORKER_THREAD_NAME = "allocation-worker"
+
+
+async def stream_batches(generator_function:Callable[..., Iterator], *args, accept:Callable[[Any],bool]=None,
+                         batch_size:int=100, max_pending_batches:int=2, use_process:bool=False)->AsyncIterator[List]:
+    """
+    Run generator_function(*args) in a worker, and generate lists of its results asynchronously.
+    :param accept: if given, only the results for which accept(result) is True are streamed.
+           The filter runs in the worker, after the stop flag is checked, so every candidate result
+           (not only every accepted one) is a point at which the search can be stopped.
+    :param max_pending_batches: the number of batches the worker may produce before they are consumed.
+    :param use_process: if True, the search runs in a separate process (so it does not compete with the event loop
+           on the GIL); the function and its arguments must then be picklable, and since the process is spawned,
+           the main module must be guarded by if __name__ == "__main__". Otherwise, the search runs in a thread.
+    NOTE: The stop flag is checked whenever the generator yields a result, so a search that should be stoppable
+          must not filter many candidates internally - pass the filter as accept instead.
+          When this generator is closed, it waits up to WORKER_JOIN_TIMEOUT seconds for the worker to exit;
+          a worker process that does not exit by then is terminated.
+
+    >>> async def count_batches():
+    ...     return [len(batch) async for batch in stream_batches(range, 10, batch_size=4)]
+    >>> asyncio.run(count_batches())
+    [4, 4, 2]
+    """
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(max_pending_batches)
+    stop = threading.Event()
+    if use_process:
+        source = _batches_from_process(generator_function, args, accept, batch_size, max_pending_batches, stop)
+    else:
+        source = _batches(generator_function(*args), accept, batch_size, stop)
+    worker = threading.Thread(target=_pump, args=(source, batches, loop, stop), name=WORKER_THREAD_NAME, daemon=True)
+    worker.start()
+    try:
+        while True:
+            (kind, payload) = await batches.get()
+            if kind == _BATCH:
+                yield payload
+            elif kind == _ERROR:
+                raise payload
+            else:
+                return
+    finally:
+        stop.set()
+        deadline = loop.time() + WORKER_JOIN_TIMEOUT
+        while worker.is_alive() and loop.time() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+def feasible_allocations_async(all_items:Bundle, num_of_agents:int, is_feasible:Callable[[Bundle,Item], bool], **kwargs)->AsyncIterator[List[Allocation]]:
+    """
+    An asynchronous version of allocations.feasible_allocations, that generates batches of allocations.
+    :param kwargs: batch_size, max_pending_batches, use_process - see stream_batches.
+
+    >>> from feasibility import at_most_1_item_per_agent
+    >>> async def collect():
+    ...     return [len(batch) async for batch in feasible_allocations_async({'x','y','z'}, 3, at_most_1_item_per_agent, batch_size=4)]
+    >>> asyncio.run(collect())
+    [4, 2]
+    """
+    return stream_batches(feasible_allocations, all_items, num_of_agents, is_feasible, **kwargs)
+
+
+def cycle_free_ef1_allocations_async(edges:List[Tuple], agents:List[AdditiveAgent], **kwargs)->AsyncIterator[List[Allocation]]:
+    """
+    An asynchronous version of cycle_free_ef1_allocations.cycle_free_ef1_allocations, that generates batches of allocations.
+    :param kwargs: batch_size, max_pending_batches, use_process - see stream_batches.
+           The worker generates all cycle-free allocations and filters the EF1 ones itself,
+           so the search can be stopped after any candidate, even if no EF1 allocation is found for a long time.
+
+    >>> edges = [('x','y'),('y','z'),('z','x')]
+    >>> agent = AdditiveAgent({edge:1 for edge in edges})
+    >>> async def collect():
+    ...     return [len(batch) async for batch in cycle_free_ef1_allocations_async(edges, [agent,agent,agent], batch_size=5, use_process=True)]
+    >>> asyncio.run(collect())
+    [5, 1]
+    """
+    return stream_batches(cycle_free_allocations, edges, len(agents), accept=functools.partial(is_EF1, agents=agents), **kwargs)
+
+
+##### IMPLEMENTATION DETAILS #####
+
+def _batches(results:Iterator, accept:Optional[Callable[[Any],bool]], batch_size:int, stop)->Iterator[List]:
+    """
+    Group the accepted results into lists of at most batch_size. Stops when the stop event is set.
+    The stop event is checked before each result is filtered: while the wrapped generator is searching
+    for its next result, it cannot be interrupted (in a worker process, it is terminated instead).
+    """
+    batch = []
+    for result in results:
+        if stop.is_set():
+            return
+        if accept is not None and not accept(result):
+            continue
+        batch.append(result)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _pump(source:Iterator[List], batches:asyncio.Queue, loop:asyncio.AbstractEventLoop, stop:threading.Event):
+    """
+    Runs in the worker thread: moves the batches from the source to the asyncio queue.
+    """
+    def put(message)->bool:
+        try:
+            future = asyncio.run_coroutine_threadsafe(batches.put(message), loop)
+        except RuntimeError:   # the event loop is closed
+            return False
+        while not stop.is_set():
+            try:
+                future.result(timeout=POLL_INTERVAL)
+                return True
+            except concurrent.futures.TimeoutError:
+                pass
+        future.cancel()
+        return False
+
+    try:
+        for batch in source:
+            if not put((_BATCH, batch)):
+                return
+        put((_DONE, None))
+    except Exception as error:
+        put((_ERROR, error))
+    finally:
+        source.close()
+
+
+def _produce_batches(generator_function:Callable[..., Iterator], args:tuple, accept:Optional[Callable[[Any],bool]], batch_size:int, results:multiprocessing.Queue, stop):
+    """
+    Runs in the worker process: puts the batches into the multiprocessing queue.
+    """
+    def put(message)->bool:
+        while not stop.is_set():
+            try:
+                results.put(message, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for batch in _batches(generator_function(*args), accept, batch_size, stop):
+            if not put((_BATCH, batch)):
+                return
+        put((_DONE, None))
+    except Exception as error:
+        put((_ERROR, error))
+
+
+def _batches_from_process(generator_function:Callable[..., Iterator], args:tuple, accept:Optional[Callable[[Any],bool]], batch_size:int, max_pending_batches:int, stop:threading.Event)->Iterator[List]:
+    """
+    Start a worker process, and generate the batches it produces. The process is stopped when the generator is closed.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue(max_pending_batches)
+    process_stop = context.Event()
+    process = context.Process(target=_produce_batches, args=(generator_function, args, accept, batch_size, results, process_stop), daemon=True)
+    process.start()
+    try:
+        while not stop.is_set():
+            try:
+                (kind, payload) = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive() and results.empty():
+                    raise RuntimeError("the worker process exited with code {}".format(process.exitcode))
+                continue
+            if kind == _BATCH:
+                yield payload
+            elif kind == _ERROR:
+                raise payload
+            else:
+                return
+    finally:
+        process_stop.set()
+        process.join(timeout=WORKER_JOIN_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+
+
+##### LOCAL SERVER #####
+
+class AllocationServer:
+    """
+    A minimal in-process server that streams allocations over TCP, one JSON line per batch.
+    Each request is one JSON line, with one of the following forms:
+        {"query": "feasible_allocations", "items": [...], "num_of_agents": 3, "constraint": "at_most_1_item_per_agent"}
+        {"query": "cycle_free_ef1_allocations", "edges": [[u,v], ...], "valuations": [[value of each edge], ...]}
+    The response is a line {"allocations": [...]} per batch, followed by {"done": true} (or {"error": "..."}).
+    Each bundle is a sorted list. When the client disconnects (even before the first batch is ready), the search is stopped.
+    The constraint must be one of the names in CONSTRAINTS.
+
+    >>> async def demo():
+    ...     async with AllocationServer(batch_size=4) as server:
+    ...         request = {"query": "feasible_allocations", "items": ["x","y","z"], "num_of_agents": 3, "constraint": "at_most_1_item_per_agent"}
+    ...         batches = [batch async for batch in query_server(server.host, server.port, request)]
+    ...         return [len(batch) for batch in batches], batches[0][0]
+    >>> asyncio.run(demo())
+    ([4, 2], [['x'], ['y'], ['z']])
+
+    When the client disconnects in the middle, the search stops:
+    >>> async def disconnect():
+    ...     async with AllocationServer(batch_size=10) as server:
+    ...         request = {"query": "feasible_allocations", "items": list("abcdefghijkl"), "num_of_agents": 3}
+    ...         batches = query_server(server.host, server.port, request)
+    ...         first_batch = await batches.__anext__()
+    ...         await batches.aclose()
+    ...         for _ in range(200):
+    ...             if server.num_of_cancelled_queries > 0: break
+    ...             await asyncio.sleep(0.01)
+    ...         workers = [thread for thread in threading.enumerate() if thread.name==WORKER_THREAD_NAME]
+    ...         return len(first_batch), server.num_of_cancelled_queries, workers
+    >>> asyncio.run(disconnect())
+    (10, 1, [])
+
+    The disconnection is noticed even while the first batch is still being searched for:
+    >>> async def disconnect_early():
+    ...     async with AllocationServer(batch_size=10**6) as server:
+    ...         edges = [(u,v) for u in range(6) for v in range(u)]
+    ...         request = {"query": "cycle_free_ef1_allocations", "edges": edges, "valuations": [[1]*len(edges)]*3}
+    ...         reader, writer = await asyncio.open_connection(server.host, server.port)
+    ...         writer.write((json.dumps(request)+"\\n").encode())
+    ...         await asyncio.sleep(0.2)
+    ...         writer.close()
+    ...         for _ in range(200):
+    ...             workers = [thread for thread in threading.enumerate() if thread.name==WORKER_THREAD_NAME]
+    ...             if server.num_of_cancelled_queries > 0 and len(workers)==0: break
+    ...             await asyncio.sleep(0.01)
+    ...         return await reader.read(), server.num_of_cancelled_queries, workers
+    >>> asyncio.run(disconnect_early())
+    (b'', 1, [])
+
+    Unknown constraints are rejected:
+    >>> async def bad_constraint():
+    ...     async with AllocationServer() as server:
+    ...         request = {"query": "feasible_allocations", "items": ["x"], "num_of_agents": 1, "constraint": "np"}
+    ...         return [batch async for batch in query_server(server.host, server.port, request)]
+    >>> asyncio.run(bad_constraint())
+    Traceback (most recent call last):
+    ...
+    RuntimeError: unknown constraint np
+    """
+
+    CONSTRAINTS = {
+        "everything_is_feasible": everything_is_feasible,
+        "at_most_1_item_per_agent": at_most_1_item_per_agent,
+        "at_most_3_items_per_agent": at_most_3_items_per_agent,
+    }
+
+    def __init__(self, host:str="127.0.0.1", port:int=0, **kwargs):
+        """
+        :param port: the port to listen on; 0 means any free port (see self.port after starting).
+        :param kwargs: batch_size, max_pending_batches, use_process - see stream_batches.
+        """
+        self.host = host
+        self.port = port
+        self.stream_options = kwargs
+        self.server = None
+        self.num_of_cancelled_queries = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def batches_for(self, request:dict)->AsyncIterator[List[Allocation]]:
+        if request["query"] == "feasible_allocations":
+            constraint_name = request.get("constraint", "everything_is_feasible")
+            if constraint_name not in self.CONSTRAINTS:
+                raise ValueError("unknown constraint {}".format(constraint_name))
+            is_feasible = self.CONSTRAINTS[constraint_name]
+            return feasible_allocations_async(set(request["items"]), request["num_of_agents"], is_feasible, **self.stream_options)
+        elif request["query"] == "cycle_free_ef1_allocations":
+            edges = [tuple(edge) for edge in request["edges"]]
+            agents = [AdditiveAgent(dict(zip(edges, values))) for values in request["valuations"]]
+            return cycle_free_ef1_allocations_async(edges, agents, **self.stream_options)
+        else:
+            raise ValueError("unknown query {}".format(request["query"]))
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        batches = next_batch = end_of_input = None
+        disconnected = False
+        try:
+            request = json.loads(await reader.readline())
+            batches = self.batches_for(request)
+            # The client sends nothing after the request, so reading returns only when it disconnects.
+            end_of_input = asyncio.ensure_future(reader.read())
+            while True:
+                next_batch = asyncio.ensure_future(batches.__anext__())
+                await asyncio.wait([next_batch, end_of_input], return_when=asyncio.FIRST_COMPLETED)
+                if not next_batch.done():
+                    raise ConnectionResetError("the client disconnected")
+                try:
+                    batch = next_batch.result()
+                except StopAsyncIteration:
+                    break
+                allocations = [[sorted(bundle) for bundle in allocation] for allocation in batch]
+                writer.write((json.dumps({"allocations": allocations})+"\n").encode())
+                await writer.drain()
+            writer.write(b'{"done": true}\n')
+            await writer.drain()
+        except ConnectionError:
+            disconnected = True
+        except Exception as error:
+            writer.write((json.dumps({"error": str(error)})+"\n").encode())
+        finally:   # a CancelledError (e.g. when the server shuts down) propagates after this cleanup.
+            if end_of_input is not None:
+                end_of_input.cancel()
+            if next_batch is not None and not next_batch.done():
+                next_batch.cancel()   # the stream cannot be closed while it is waiting for a batch.
+                await asyncio.gather(next_batch, return_exceptions=True)
+            if batches is not None:
+                await batches.aclose()
+            writer.close()
+            if disconnected:
+                self.num_of_cancelled_queries += 1
+
+
+async def query_server(host:str, port:int, request:dict)->AsyncIterator[List]:
+    """
+    Send a request to an AllocationServer, and generate the batches of allocations it returns.
+    Closing this generator early disconnects from the server, which stops the search.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps(request)+"\n").encode())
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("the server closed the connection")
+            response = json.loads(line)
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            if response.get("done"):
+                return
+            yield response["allocations"]
+    finally:
+        writer.close()
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -15,19 +15,154 @@ Allocation = List[Bundle]
 from allocations import *
 from agents import *
 
+import numpy as np
+import json
+
 import logging
 logger = logging.getLogger(__name__)
 
 
-def capped_round_robin(remaining_items:Bundle, agents:List[AdditiveAgentWithCategoryCapacities], category_index:int, agent_order:List[int]):
-    logger.info("\nCapped Round Robin in category %d, order %s", category_index, agent_order)
+class TraceArrays(NamedTuple):
+    events: np.ndarray
+    items: np.ndarray
+    orders: List[List[int]]
+
+
+class RoundRobinTrace:
+    """
+    A structured trace of the events in a run of capped round robin.
+    Each event is a row (kind, round, agent index, item index, category index), stored in a preallocated NumPy array.
+    Items are stored as indices into self.items; agents are indices into the list of agents.
+    The trace is optional: when no trace is given to capped_round_robin, nothing is recorded.
+
+    >>> trace = RoundRobinTrace(capacity=2)
+    >>> trace.start(0, [1,0])
+    >>> trace.pick(0, 1, 'ax', 0)
+    >>> trace.saturated(1, 1, 0)
+    >>> len(trace)
+    3
+    >>> arrays = trace.to_numpy()
+    >>> arrays.events['item'].tolist()
+    [-1, 0, -1]
+    >>> arrays.items[arrays.events['item'][1]], arrays.orders
+    ('ax', [[1, 0]])
+    >>> for line in trace.to_json_lines(): print(line)
+    {"event": "start", "round": 0, "agent": -1, "item": null, "category": 0, "order": [1, 0]}
+    {"event": "pick", "round": 0, "agent": 1, "item": "ax", "category": 0}
+    {"event": "saturated", "round": 1, "agent": 1, "item": null, "category": 0}
+    """
+
+    START = 0
+    PICK = 1
+    SATURATED = 2
+    EVENT_NAMES = ["start", "pick", "saturated"]
+    EVENT_DTYPE = np.dtype([('kind', np.int8), ('round', np.int32), ('agent', np.int32), ('item', np.int32), ('category', np.int32)])
+
+    def __init__(self, capacity:int=1024):
+        """
+        :param capacity: the initial number of events to allocate room for. The array is doubled whenever it is full.
+        """
+        self.events = np.zeros(capacity, dtype=self.EVENT_DTYPE)
+        self.num_of_events = 0
+        self.items = []
+        self.item_indices = {}
+        self.orders = []     # the agent order of each start event
+
+    def __len__(self):
+        return self.num_of_events
+
+    def record(self, kind:int, round_index:int, agent_index:int, item_index:int, category_index:int):
+        if self.num_of_events == len(self.events):
+            self.events = np.concatenate((self.events, np.zeros(max(len(self.events),1), dtype=self.EVENT_DTYPE)))
+        self.events[self.num_of_events] = (kind, round_index, agent_index, item_index, category_index)
+        self.num_of_events += 1
+
+    def start(self, category_index:int, agent_order:List[int]):
+        self.record(self.START, 0, -1, -1, category_index)
+        self.orders.append(list(agent_order))
+
+    def pick(self, round_index:int, agent_index:int, item:Item, category_index:int):
+        item_index = self.item_indices.get(item)
+        if item_index is None:
+            item_index = self.item_indices[item] = len(self.items)
+            self.items.append(item)
+        self.record(self.PICK, round_index, agent_index, item_index, category_index)
+
+    def saturated(self, round_index:int, agent_index:int, category_index:int):
+        self.record(self.SATURATED, round_index, agent_index, -1, category_index)
+
+    def to_numpy(self)->"TraceArrays":
+        """
+        Return the events as a structured array with the fields kind, round, agent, item, category,
+        together with the tables needed to decode it:
+        items[k] is the item whose index is k, and orders[s] is the agent order of the s-th start event.
+        """
+        items = np.empty(len(self.items), dtype=object)
+        for item_index,item in enumerate(self.items):   # element by element, so that tuple items stay intact
+            items[item_index] = item
+        return TraceArrays(self.events[:self.num_of_events].copy(), items, [list(order) for order in self.orders])
+
+    def to_json_lines(self)->Iterator[str]:
+        """
+        Generate one JSON object per event, with the actual items instead of item indices.
+        """
+        starts = iter(self.orders)
+        for (kind, round_index, agent_index, item_index, category_index) in self.events[:self.num_of_events].tolist():
+            event = {"event": self.EVENT_NAMES[kind], "round": round_index, "agent": agent_index,
+                     "item": self.items[item_index] if item_index>=0 else None, "category": category_index}
+            if kind == self.START:
+                event["order"] = next(starts)
+            yield json.dumps(event)
+
+    def render(self, agents:List[Agent])->Iterator[str]:
+        """
+        Generate a human-readable description of each event.
+
+        >>> Alice = AdditiveAgentWithCategoryCapacities([(1, {'ax': 9, 'ay': 8})], "Alice")
+        >>> Bob = AdditiveAgentWithCategoryCapacities([(1, {'ax': 8, 'ay': 9})], "Bob")
+        >>> trace = RoundRobinTrace()
+        >>> allocation = category_capped_round_robin(Alice.all_items(), [Alice,Bob], {0: [0,1]}, trace)
+        >>> for line in trace.render([Alice,Bob]): print(line)
+        <BLANKLINE>
+        Capped Round Robin in category 0, order [0, 1]
+        Alice takes ax
+        Bob takes ay
+        """
+        starts = iter(self.orders)
+        for (kind, round_index, agent_index, item_index, category_index) in self.events[:self.num_of_events].tolist():
+            if kind == self.START:
+                yield "\nCapped Round Robin in category {}, order {}".format(category_index, next(starts))
+            elif kind == self.PICK:
+                yield "{} takes {}".format(agents[agent_index].name(), self.items[item_index])
+            else:
+                yield "{} is saturated".format(agents[agent_index].name())
+
+    def log(self, agents:List[Agent], log:logging.Logger=logger):
+        """
+        Write the human-readable description of the trace to the given logger, at level INFO.
+        """
+        for line in self.render(agents):
+            log.info(line)
+
+
+def capped_round_robin(remaining_items:Bundle, agents:List[AdditiveAgentWithCategoryCapacities], category_index:int, agent_order:List[int], trace:RoundRobinTrace=None):
+    """
+    Run round robin on the items of the given category, where each agent stops picking once it is saturated.
+    :param trace: if given, every start, pick and saturation event is recorded in it.
+    NOTE: this function no longer writes to the logger while it runs, so enabling INFO logging alone prints nothing;
+          to get the previous messages, pass a RoundRobinTrace and call trace.log(agents) afterwards.
+    """
+    if trace is not None:
+        trace.start(category_index, agent_order)
     allocation = [[] for _ in agents]
+    round_index = 0
     while True:
         for agent_index in agent_order:
             agent = agents[agent_index]
             bundle = allocation[agent_index]
             if agent.is_saturated(bundle, category_index):
-                logger.info("%s is saturated", agent.name())
+                if trace is not None:
+                    trace.saturated(round_index, agent_index, category_index)
                 agent_order.remove(agent_index)
                 if len(agent_order) == 0:
                     raise RuntimeError("All agents are saturated, but some items remain")
@@ -35,16 +170,18 @@ def capped_round_robin(remaining_items:Bundle, agents:List[AdditiveAgentWithCate
                 item = agent.best_category_item_in_bundle(remaining_items, category_index)
                 allocation[agent_index].append(item)
                 remaining_items.remove(item)
-                logger.info("%s takes %s", agent.name(), item)
+                if trace is not None:
+                    trace.pick(round_index, agent_index, item, category_index)
                 if agent.num_category_items_in_bundle(remaining_items, category_index)==0:  # no more items in category
                     return allocation
+        round_index += 1
 
 
-def category_capped_round_robin(all_items:Bundle, agents:List[AdditiveAgentWithCategoryCapacities], map_category_index_to_agent_order:Dict[int,List[int]]):
+def category_capped_round_robin(all_items:Bundle, agents:List[AdditiveAgentWithCategoryCapacities], map_category_index_to_agent_order:Dict[int,List[int]], trace:RoundRobinTrace=None):
     allocation = [[] for _ in agents]
     remaining_items = list(all_items)
     for category_index,agent_order in map_category_index_to_agent_order.items():
-        category_allocation = capped_round_robin(remaining_items, agents, category_index, agent_order)
+        category_allocation = capped_round_robin(remaining_items, agents, category_index, agent_order, trace)
         for i in range(len(agents)):
             allocation[i] += category_allocation[i]
     return allocation
@@ -72,7 +209,9 @@ if __name__ == "__main__":
     all_items = Alice.all_items()
 
     # logger.setLevel(logging.INFO)
-    # print(stringify_allocation_and_values(category_capped_round_robin(all_items, agents, {0: [0,1], 1:[1,0]}), agents))
+    # trace = RoundRobinTrace()
+    # print(stringify_allocation_and_values(category_capped_round_robin(all_items, agents, {0: [0,1], 1:[1,0]}, trace), agents))
+    # trace.log(agents)
     # print()
     # print(stringify_allocation_and_values(category_capped_round_robin(all_items, agents, {0: [1,0], 1:[0,1]}), agents))
 
@@ -0,0 +1,509 @@
+"""
+Local search for repairing a given allocation into an allocation that is both EF1 and feasible.
+
+The search starts from a (possibly unfair) allocation, e.g. the output of category_capped_round_robin,
+and repeatedly transfers or swaps items.
+The allocation is kept in an IncrementalAllocation, which maintains the envy data incrementally,
+so that each candidate move is evaluated in time O(n) (times the number of categories, with category capacities),
+where n is the number of agents.
+
+Author: Erel Segal-Halevi
+Since:  2020-08
+"""
+
+import math, time
+from bisect import bisect_left, bisect_right, insort
+
+from typing import *
+Item = Any
+Bundle = Set[Item]
+Allocation = List[Bundle]
+
+from agents import Agent, AdditiveAgentWithCapacity, AdditiveAgentWithCategoryCapacities
+from feasibility import everything_is_feasible, Constraint, CompiledConstraint
+
+# A move is either a transfer (item, None, target_bundle_index) or a swap (item, other_item, None).
+Move = Tuple[Item, Optional[Item], Optional[int]]
+
+
+class IncrementalAllocation:
+    """
+    A mutable allocation that keeps, for every pair of agents (i,j) and every category c of agent i:
+    * The values (for agent i) of the items of category c in the bundle of agent j, sorted in descending order;
+    * The value of agent i for these items, taking the capacity of category c into account;
+    * The largest decrease in this value that can be caused by removing a single item.
+    From these, it keeps the value of agent i for the bundle of agent j,
+    and the EF1 deficit of agent i towards agent j, i.e., by how much the EF1 condition is violated (0 if it is satisfied).
+
+    The agents must be AdditiveAgent, AdditiveAgentWithCapacity or AdditiveAgentWithCategoryCapacities.
+    An additive agent has a single category with no capacity, and an agent with a capacity has a single category with that capacity.
+    Each bundle must respect the capacities of its owner.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':4, 'y':3, 'z':2, 'w':1}, "Alice")
+    >>> Bob = AdditiveAgent({'x':1, 'y':2, 'z':3, 'w':4}, "Bob")
+    >>> a = IncrementalAllocation([{'x','y','z','w'}, set()], [Alice, Bob])
+    >>> a.violating_pairs()
+    [(1, 0)]
+    >>> a.value(1, 0)
+    10
+    >>> a.evaluate_transfer('w', 1)
+    (0, 0)
+    >>> a.transfer('w', 1)
+    >>> a.violating_pairs()
+    []
+    >>> a.evaluate_swap('x', 'w')
+    (1, 4)
+
+    With capacities, the value of other bundles is capped too:
+    >>> Carl = AdditiveAgentWithCategoryCapacities([(1, {'ax':9, 'ay':8, 'az':7}), (1, {'bx':10})], "Carl")
+    >>> Dana = AdditiveAgentWithCategoryCapacities([(3, {'ax':9, 'ay':8, 'az':7}), (1, {'bx':10})], "Dana")
+    >>> a = IncrementalAllocation([{'bx'}, {'ax','ay','az'}], [Carl, Dana])
+    >>> a.value(0, 1)
+    9
+    >>> a.violating_pairs()
+    []
+    >>> a.evaluate_transfer('bx', 1)
+    (1, 9)
+    """
+
+    def __init__(self, allocation:Allocation, agents:List[Agent], is_feasible:Callable[[Bundle,Item], bool]=everything_is_feasible):
+        """
+        :param allocation: a list of bundles (sets or lists of items), one per agent.
+        :param agents: a list of additive agents.
+        :param is_feasible: a function that accepts a bundle and a potential item to add to it,
+               and returns True iff the new bundle (bundle+item) is feasible.
+               It can also be a declarative Constraint, which is then compiled for the allocated items,
+               or a CompiledConstraint; in both cases, the state of each bundle is kept, so each check takes a few integer operations.
+        NOTE: The feasibility constraint must be downwards-closed, and the initial allocation must be feasible.
+        """
+        num_of_agents = len(agents)
+        if len(allocation)!=num_of_agents:
+            raise ValueError("allocation has {} bundles but there are {} agents".format(len(allocation),num_of_agents))
+        self.agents = agents
+        self.num_of_agents = num_of_agents
+        self.bundles = [set(bundle) for bundle in allocation]
+        self.owner = {item:j for j,bundle in enumerate(self.bundles) for item in bundle}
+        if isinstance(is_feasible, Constraint):
+            is_feasible = is_feasible.compile(list(self.owner))
+        self.is_feasible = is_feasible
+        if isinstance(is_feasible, CompiledConstraint):
+            self.constraint_states = [is_feasible.state_of(bundle) for bundle in self.bundles]
+        self.item_values = [
+            {item: agent.item_value(item) for item in self.owner}
+            for agent in agents]
+
+        # The categories of each agent: item_category maps items to categories,
+        # and items not in item_category are in default_category (None means that they are worthless).
+        self.item_category = [{} for _ in agents]
+        self.default_category = [None for _ in agents]
+        self.category_capacity = [[] for _ in agents]    # None means no capacity
+        for i,agent in enumerate(agents):
+            if isinstance(agent, AdditiveAgentWithCategoryCapacities):
+                for (category_index,(capacity,values)) in enumerate(agent.categories):
+                    for item in values:
+                        self.item_category[i][item] = category_index
+                    self.category_capacity[i].append(capacity)
+            else:
+                self.default_category[i] = 0
+                self.category_capacity[i].append(agent.capacity if isinstance(agent, AdditiveAgentWithCapacity) else None)
+
+        n = num_of_agents
+        self.sorted_values = [[[[] for _ in self.category_capacity[i]] for j in range(n)] for i in range(n)]  # negated, ascending
+        self.category_values = [[[0 for _ in self.category_capacity[i]] for j in range(n)] for i in range(n)]
+        self.reductions = [[[0 for _ in self.category_capacity[i]] for j in range(n)] for i in range(n)]
+        self.values = [[0]*n for _ in range(n)]
+        self.max_reductions = [[0]*n for _ in range(n)]
+        for i in range(n):
+            for j in range(n):
+                for item in self.bundles[j]:
+                    category_index = self._category(i, item)
+                    if category_index is not None:
+                        insort(self.sorted_values[i][j][category_index], -self.item_values[i][item])
+                for category_index,capacity in enumerate(self.category_capacity[i]):
+                    negated_values = self.sorted_values[i][j][category_index]
+                    self.category_values[i][j][category_index] = -sum(negated_values[:capacity])
+                    self.reductions[i][j][category_index] = _kth(negated_values, 0) - _kth(negated_values, capacity)
+                self.values[i][j] = sum(self.category_values[i][j])
+                self.max_reductions[i][j] = max(self.reductions[i][j], default=0)
+        for j in range(n):
+            for category_index,capacity in enumerate(self.category_capacity[j]):
+                count = len(self.sorted_values[j][j][category_index])
+                if capacity is not None and count > capacity:
+                    raise ValueError("bundle {} has {} items in category {}, but the capacity is {}".format(
+                        j, count, category_index, capacity))
+
+        self.deficits = [[0]*n for _ in range(n)]
+        self.num_of_violations = 0
+        self.total_deficit = 0
+        for i in range(n):
+            for j in range(n):
+                if i!=j:
+                    self._set_deficit(i, j, self._deficit(self.values[i][i], self.values[i][j], self.max_reductions[i][j]))
+
+    ### Queries
+
+    def allocation(self)->Allocation:
+        return [set(bundle) for bundle in self.bundles]
+
+    def value(self, agent_index:int, bundle_index:int)->float:
+        """
+        Return the value of the given agent for the given bundle.
+        """
+        return self.values[agent_index][bundle_index]
+
+    def violating_pairs(self)->List[Tuple[int,int]]:
+        """
+        Return all pairs (i,j) such that agent i envies agent j even after removing the best item from j's bundle.
+        """
+        return [(i,j) for i in range(self.num_of_agents) for j in range(self.num_of_agents) if self.deficits[i][j]>0]
+
+    def score(self)->Tuple[int,float]:
+        """
+        Return (number of violating pairs, total EF1 deficit). Lower is better; (0,0) means EF1.
+        """
+        return (self.num_of_violations, self.total_deficit)
+
+    def can_transfer(self, item:Item, target:int)->bool:
+        """
+        Return True iff the item can be moved to the bundle of the given target agent without violating feasibility.
+        """
+        return self.owner[item]!=target and self._can_add(target, None, item)
+
+    def can_swap(self, item:Item, other_item:Item)->bool:
+        """
+        Return True iff the two items can be exchanged between their bundles without violating feasibility.
+        """
+        source = self.owner[item]
+        target = self.owner[other_item]
+        return source!=target and self._can_add(target, other_item, item) and self._can_add(source, item, other_item)
+
+    def evaluate_transfer(self, item:Item, target:int)->Tuple[int,float]:
+        """
+        Return the score() the allocation would have after moving the item to the target bundle.
+        Runs in time O(n). Does not check feasibility.
+        """
+        source = self.owner[item]
+        return self._evaluate({source: (item, None), target: (None, item)})
+
+    def evaluate_swap(self, item:Item, other_item:Item)->Tuple[int,float]:
+        """
+        Return the score() the allocation would have after exchanging the two items.
+        Runs in time O(n). Does not check feasibility.
+        """
+        source = self.owner[item]
+        target = self.owner[other_item]
+        return self._evaluate({source: (item, other_item), target: (other_item, item)})
+
+    ### Modifications
+
+    def transfer(self, item:Item, target:int):
+        """
+        Move the item to the target bundle.
+        """
+        source = self.owner[item]
+        self._apply({source: (item, None), target: (None, item)})
+
+    def swap(self, item:Item, other_item:Item):
+        """
+        Exchange the two items between their bundles.
+        """
+        source = self.owner[item]
+        target = self.owner[other_item]
+        self._apply({source: (item, other_item), target: (other_item, item)})
+
+    ### Implementation details
+
+    @staticmethod
+    def _deficit(own_value:float, other_value:float, max_reduction:float)->float:
+        return max(0, other_value - max_reduction - own_value)
+
+    def _set_deficit(self, i:int, j:int, deficit:float):
+        old_deficit = self.deficits[i][j]
+        self.num_of_violations += (deficit>0) - (old_deficit>0)
+        self.total_deficit += deficit - old_deficit
+        self.deficits[i][j] = deficit
+
+    def _category(self, agent_index:int, item:Item)->Optional[int]:
+        return self.item_category[agent_index].get(item, self.default_category[agent_index])
+
+    def _can_add(self, bundle_index:int, removed:Optional[Item], added:Item)->bool:
+        category_index = self._category(bundle_index, added)
+        if category_index is not None:
+            capacity = self.category_capacity[bundle_index][category_index]
+            if capacity is not None:
+                count = len(self.sorted_values[bundle_index][bundle_index][category_index])
+                if removed is not None and self._category(bundle_index, removed)==category_index:
+                    count -= 1
+                if count >= capacity:
+                    return False
+        if isinstance(self.is_feasible, CompiledConstraint):
+            constraint = self.is_feasible
+            state = self.constraint_states[bundle_index]
+            if removed is not None:
+                state = constraint.remove(state, constraint.index[removed])
+            return constraint.can_add(state, constraint.index[added])
+        bundle = self.bundles[bundle_index]
+        if removed is not None:
+            bundle = bundle - {removed}
+        return self.is_feasible(bundle, added)
+
+    def _changed_categories(self, i:int, removed:Optional[Item], added:Optional[Item])->Dict[int,List[Optional[float]]]:
+        """
+        Map each category of agent i that is changed by the move to [removed value, added value].
+        """
+        changed = {}
+        if removed is not None:
+            category_index = self._category(i, removed)
+            if category_index is not None:
+                changed.setdefault(category_index, [None,None])[0] = self.item_values[i][removed]
+        if added is not None:
+            category_index = self._category(i, added)
+            if category_index is not None:
+                changed.setdefault(category_index, [None,None])[1] = self.item_values[i][added]
+        return changed
+
+    def _category_after(self, i:int, j:int, category_index:int, removed_value:Optional[float], added_value:Optional[float])->Tuple[float,float]:
+        """
+        Return the capped value and the largest single-item reduction of a category of agent i in bundle j,
+        after removing an item with removed_value and adding an item with added_value (each may be None).
+        Runs in time O(log k), where k is the number of items of the category in the bundle.
+        """
+        negated_values = self.sorted_values[i][j][category_index]
+        capacity = self.category_capacity[i][category_index]
+        value = self.category_values[i][j][category_index]
+        if removed_value is not None:
+            if capacity is None:
+                value -= removed_value
+            elif bisect_left(negated_values, -removed_value) < capacity:
+                value += _kth(negated_values, capacity) - removed_value
+        if added_value is not None:
+            if capacity is None:
+                value += added_value
+            elif _position(negated_values, removed_value, added_value) < capacity:
+                value += added_value - _kth(negated_values, capacity-1, removed_value)
+        reduction = _kth(negated_values, 0, removed_value, added_value) - _kth(negated_values, capacity, removed_value, added_value)
+        return (value, reduction)
+
+    def _bundle_after(self, i:int, j:int, removed:Optional[Item], added:Optional[Item])->Tuple[float,float,Dict[int,Tuple[float,float]]]:
+        """
+        Return the value of agent i for bundle j after the change, the largest single-item reduction,
+        and the new (value, reduction) of each changed category.
+        """
+        value = self.values[i][j]
+        reductions = self.reductions[i][j]
+        new_categories = {}
+        for category_index,(removed_value,added_value) in self._changed_categories(i, removed, added).items():
+            new_categories[category_index] = self._category_after(i, j, category_index, removed_value, added_value)
+            value += new_categories[category_index][0] - self.category_values[i][j][category_index]
+        if len(new_categories)==0:
+            return (value, self.max_reductions[i][j], new_categories)
+        max_reduction = max([new_categories[category_index][1] if category_index in new_categories else reductions[category_index]
+                             for category_index in range(len(reductions))])
+        return (value, max_reduction, new_categories)
+
+    def _evaluate(self, changes:Dict[int,Tuple[Optional[Item],Optional[Item]]])->Tuple[int,float]:
+        """
+        :param changes: maps each changed bundle to a pair (removed item, added item); each may be None.
+        :return: the score after the changes.
+        """
+        new_bundles = {}
+        for j,(removed,added) in changes.items():
+            for i in range(self.num_of_agents):
+                new_bundles[i,j] = self._bundle_after(i, j, removed, added)
+        num_of_violations = self.num_of_violations
+        total_deficit = self.total_deficit
+        for (i,j) in self._affected_pairs(changes):
+            own_value = new_bundles[i,i][0] if (i,i) in new_bundles else self.values[i][i]
+            if (i,j) in new_bundles:
+                (other_value, max_reduction, _) = new_bundles[i,j]
+            else:
+                (other_value, max_reduction) = (self.values[i][j], self.max_reductions[i][j])
+            new_deficit = self._deficit(own_value, other_value, max_reduction)
+            old_deficit = self.deficits[i][j]
+            num_of_violations += (new_deficit>0) - (old_deficit>0)
+            total_deficit += new_deficit - old_deficit
+        return (num_of_violations, total_deficit)
+
+    def _affected_pairs(self, changes:Dict[int,Any])->Set[Tuple[int,int]]:
+        n = self.num_of_agents
+        pairs = set()
+        for j in changes:
+            for k in range(n):
+                if k!=j:
+                    pairs.add((k,j))   # agent k's view of the changed bundle
+                    pairs.add((j,k))   # the owner of the changed bundle has a new value
+        return pairs
+
+    def _apply(self, changes:Dict[int,Tuple[Optional[Item],Optional[Item]]]):
+        for j,(removed,added) in changes.items():
+            for i in range(self.num_of_agents):
+                (value, max_reduction, new_categories) = self._bundle_after(i, j, removed, added)
+                self.values[i][j] = value
+                self.max_reductions[i][j] = max_reduction
+                for category_index,(category_value,reduction) in new_categories.items():
+                    self.category_values[i][j][category_index] = category_value
+                    self.reductions[i][j][category_index] = reduction
+                for category_index,(removed_value,added_value) in self._changed_categories(i, removed, added).items():
+                    negated_values = self.sorted_values[i][j][category_index]
+                    if removed_value is not None:
+                        del negated_values[bisect_left(negated_values, -removed_value)]
+                    if added_value is not None:
+                        insort(negated_values, -added_value)
+            if removed is not None:
+                self.bundles[j].remove(removed)
+            if added is not None:
+                self.bundles[j].add(added)
+                self.owner[added] = j
+            if isinstance(self.is_feasible, CompiledConstraint):
+                constraint = self.is_feasible
+                if removed is not None:
+                    self.constraint_states[j] = constraint.remove(self.constraint_states[j], constraint.index[removed])
+                if added is not None:
+                    self.constraint_states[j] = constraint.add(self.constraint_states[j], constraint.index[added])
+        for (i,j) in self._affected_pairs(changes):
+            self._set_deficit(i, j, self._deficit(self.values[i][i], self.values[i][j], self.max_reductions[i][j]))
+
+
+def _kth(negated_values:List[float], k:Optional[int], removed_value:Optional[float]=None, added_value:Optional[float]=None)->float:
+    """
+    Return the k-th largest value (counting from 0) after removing removed_value from
+    and adding added_value to the given values (given negated, in ascending order); 0 if there is no such value.
+    k=None stands for infinity.
+
+    >>> _kth([-5,-3,-1], 1), _kth([-5,-3,-1], 1, 5), _kth([-5,-3,-1], 1, None, 4), _kth([-5,-3,-1], 3), _kth([-5,-3,-1], None)
+    (3, 1, 4, 0, 0)
+    """
+    if k is None:
+        return 0
+    if added_value is not None:
+        position = _position(negated_values, removed_value, added_value)
+        if k == position:
+            return added_value
+        if k > position:
+            k -= 1
+    if removed_value is not None and k >= bisect_left(negated_values, -removed_value):
+        k += 1
+    return -negated_values[k] if k < len(negated_values) else 0
+
+
+def _position(negated_values:List[float], removed_value:Optional[float], added_value:float)->int:
+    """
+    Return the position in which added_value is inserted, after removed_value is removed.
+    """
+    position = bisect_right(negated_values, -added_value)
+    if removed_value is not None and removed_value >= added_value:
+        position -= 1
+    return position
+
+
+class LocalSearchResult(NamedTuple):
+    allocation: Allocation
+    violating_pairs: List[Tuple[int,int]]
+    num_of_moves: int
+
+
+def ef1_local_search(allocation:Allocation, agents:List[Agent], is_feasible:Callable[[Bundle,Item], bool]=everything_is_feasible, time_limit:float=10)->LocalSearchResult:
+    """
+    Starting from the given feasible allocation, look for a feasible EF1 allocation by transferring and swapping items.
+    In each step, the algorithm picks a pair (i,j) in which agent i has the largest EF1 deficit towards agent j,
+    and performs the best move that takes an item out of j's bundle (a transfer to any agent, or a swap with i's bundle),
+    if this move improves the score (number of violating pairs, total deficit).
+    It stops when the allocation is EF1, when no violating pair has an improving move, or when the time limit is reached.
+
+    :param allocation: an initial feasible allocation (a list of bundles).
+    :param agents: a list of additive agents.
+    :param is_feasible: a downwards-closed feasibility constraint, as in allocations.feasible_allocations.
+    :param time_limit: maximum run-time in seconds (of the search; building the initial IncrementalAllocation is not counted).
+           The deadline is checked before each candidate move is evaluated, so it is overrun by at most one evaluation.
+    :return: the final allocation, the pairs (i,j) in which agent i still violates EF1 towards j, and the number of moves.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':4, 'y':3, 'z':2, 'w':1}, "Alice")
+    >>> Bob = AdditiveAgent({'x':1, 'y':2, 'z':3, 'w':4}, "Bob")
+    >>> result = ef1_local_search([{'x','y','z','w'}, set()], [Alice, Bob])
+    >>> result.violating_pairs
+    []
+    >>> result.num_of_moves
+    1
+    >>> from fairness import is_EF1
+    >>> is_EF1(result.allocation, [Alice, Bob])
+    True
+    >>> from feasibility import at_most_1_item_per_agent
+    >>> ef1_local_search([{'x'}, {'w'}], [Alice, Bob], at_most_1_item_per_agent).violating_pairs
+    []
+    >>> from feasibility import Cardinality, Conflicts
+    >>> result = ef1_local_search([{'x','y','z'}, set()], [Alice, Bob], Cardinality(3) & Conflicts([('y','z')]))
+    >>> result.violating_pairs, len(result.allocation[1])
+    ([], 1)
+
+    Agents with category capacities:
+    >>> Alice = AdditiveAgentWithCategoryCapacities([(2, {'ax':9, 'ay':8, 'az':7}), (1, {'bx':9, 'by':8, 'bz':7})], "Alice")
+    >>> Bob   = AdditiveAgentWithCategoryCapacities([(1, {'ax':9, 'ay':8, 'az':7}), (2, {'bx':9, 'by':8, 'bz':7})], "Bob")
+    >>> result = ef1_local_search([{'ax','ay','bx'}, {'az','by','bz'}], [Alice, Bob])
+    >>> result.violating_pairs
+    []
+
+    The time limit is respected even when a single scan for the best move is long:
+    >>> import random
+    >>> rnd = random.Random(1)
+    >>> items = range(400)
+    >>> agents = [AdditiveAgent({item:rnd.randint(1,100) for item in items}) for _ in range(20)]
+    >>> start = time.perf_counter()
+    >>> result = ef1_local_search([set(items)]+[set()]*19, agents, time_limit=0.2)
+    >>> time.perf_counter()-start < 1
+    True
+    >>> len(result.violating_pairs) > 0
+    True
+    """
+    deadline = time.perf_counter() + time_limit
+    state = IncrementalAllocation(allocation, agents, is_feasible)
+    num_of_moves = 0
+    while state.num_of_violations > 0 and time.perf_counter() < deadline:
+        pairs = sorted(state.violating_pairs(), key=lambda pair: -state.deficits[pair[0]][pair[1]])
+        move = None
+        for (i,j) in pairs:
+            move = _best_move(state, i, j, deadline)
+            if move is not None or time.perf_counter() >= deadline:
+                break
+        if move is None:
+            break   # local optimum, or out of time
+        (item, other_item, target) = move
+        if other_item is None:
+            state.transfer(item, target)
+        else:
+            state.swap(item, other_item)
+        num_of_moves += 1
+    return LocalSearchResult(state.allocation(), state.violating_pairs(), num_of_moves)
+
+
+def _best_move(state:IncrementalAllocation, envious:int, envied:int, deadline:float=math.inf)->Optional[Move]:
+    """
+    Return the feasible move out of the envied bundle that most improves the score, or None if there is no improving move.
+    If the deadline (in time.perf_counter() units) passes during the scan, return the best move found so far.
+    """
+    best_score = state.score()
+    best_move = None
+    for item in state.bundles[envied]:
+        if time.perf_counter() >= deadline:
+            break
+        for target in range(state.num_of_agents):
+            if target!=envied and state.can_transfer(item, target):
+                score = state.evaluate_transfer(item, target)
+                if score < best_score:
+                    best_score, best_move = score, (item, None, target)
+        for other_item in state.bundles[envious]:
+            if time.perf_counter() >= deadline:
+                break
+            if state.can_swap(item, other_item):
+                score = state.evaluate_swap(item, other_item)
+                if score < best_score:
+                    best_score, best_move = score, (item, other_item, None)
+    return best_move
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -1,11 +1,13 @@
 """
-Check fairness of allocations.
+Check fairness of allocations: EF1, EFX, PROP1 and MMS.
 
 Author: Erel Segal-Halevi
 Since: 2020-04
 """
 
-from agents import Agent
+from agents import Agent, AdditiveAgent, AdditiveAgentWithCapacity, AdditiveAgentWithCategoryCapacities
+from feasibility import everything_is_feasible, Constraint, Cardinality, CategoryCapacities, AllOf
+from functools import lru_cache
 
 from typing import *
 Item = Any
@@ -31,3 +33,280 @@ def is_EF1(allocation:Allocation, agents:List[Agent]):
                     return False
     return True
 
+
+class AllocationValues:
+    """
+    Valuation data of the agents for a given allocation, computed once and shared by the fairness checkers:
+    the value of each agent for each bundle, and the value of each agent for each single item.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':1, 'y':2, 'z':4}, "Alice")
+    >>> values = AllocationValues([{'x'}, {'y','z'}], [Alice, Alice])
+    >>> values.bundle_values
+    [[1, 6], [1, 6]]
+    >>> values.value_without_least_item(0, 1)
+    4
+    >>> values.value_with_best_item(0)
+    5
+
+    Agents that are not additive are evaluated with their value function:
+    >>> class BestItemAgent(Agent):
+    ...     def value(self, items): return max([{'x':1, 'y':2, 'z':4}[item] for item in items], default=0)
+    ...     def total_value(self): return 4
+    >>> values = AllocationValues([{'z'}, {'x','y'}], [BestItemAgent(), BestItemAgent()])
+    >>> values.value_without_least_item(0, 1), values.value_with_best_item(1)
+    (2, 4)
+    >>> is_EFX([{'z'}, {'x','y'}], [BestItemAgent(), BestItemAgent()])
+    True
+    """
+
+    def __init__(self, allocation:Allocation, agents:List[Agent]):
+        num_of_agents = len(agents)
+        if len(allocation)!=num_of_agents:
+            raise ValueError("allocation has {} bundles but there are {} agents".format(len(allocation),num_of_agents))
+        self.allocation = allocation
+        self.agents = agents
+        self.all_items = [item for bundle in allocation for item in bundle]
+        self.bundle_values = [[agent.value(bundle) for bundle in allocation] for agent in agents]
+        self.item_values = [{item: _item_value(agent, item) for item in self.all_items} for agent in agents]
+        self.is_additive = [isinstance(agent, AdditiveAgent) and type(agent).value is AdditiveAgent.value for agent in agents]
+
+    def value_without_least_item(self, agent_index:int, bundle_index:int)->float:
+        """
+        The largest value of the agent for the bundle minus one item that is positive for the agent.
+        """
+        bundle = self.allocation[bundle_index]
+        item_values = self.item_values[agent_index]
+        positive_items = [item for item in bundle if item_values[item] > 0]
+        if len(positive_items)==0:
+            return self.bundle_values[agent_index][bundle_index]
+        if self.is_additive[agent_index]:
+            return self.bundle_values[agent_index][bundle_index] - min([item_values[item] for item in positive_items])
+        agent = self.agents[agent_index]
+        return max([agent.value([other for other in bundle if other!=item]) for item in positive_items])
+
+    def value_with_best_item(self, agent_index:int)->float:
+        """
+        The largest value of the agent for its own bundle plus one item from another bundle.
+        """
+        bundle = self.allocation[agent_index]
+        item_values = self.item_values[agent_index]
+        other_items = [item for item in self.all_items if item not in bundle]
+        if len(other_items)==0:
+            return self.bundle_values[agent_index][agent_index]
+        if self.is_additive[agent_index]:
+            return self.bundle_values[agent_index][agent_index] + max([item_values[item] for item in other_items])
+        agent = self.agents[agent_index]
+        return max([agent.value(list(bundle)+[item]) for item in other_items])
+
+    def total_value(self, agent_index:int)->float:
+        """
+        The value of the agent for all allocated items.
+        """
+        return self.agents[agent_index].value(self.all_items)
+
+
+def _item_value(agent:Agent, item:Item)->float:
+    if isinstance(agent, AdditiveAgent):
+        return agent.item_value(item)
+    return agent.value([item])
+
+
+def is_EFX(allocation:Allocation, agents:List[Agent], values:AllocationValues=None)->bool:
+    """
+    Check if the allocation is envy-free up to any item:
+    each agent values its bundle at least as much as any other bundle minus any item that the agent values positively.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':1, 'y':1, 'z':3, 'w':1}, "Alice")
+    >>> is_EFX([{'x','y'}, {'z','w'}], [Alice, Alice])
+    False
+    >>> is_EF1([{'x','y'}, {'z','w'}], [Alice, Alice])
+    True
+    >>> is_EFX([{'x','y'}, {'z','w'}], [AdditiveAgent({'x':1, 'y':1, 'z':3, 'w':0}), Alice])
+    True
+    """
+    if values is None:
+        values = AllocationValues(allocation, agents)
+    for i in range(len(agents)):
+        for j in range(len(agents)):
+            if i!=j and values.bundle_values[i][i] < values.value_without_least_item(i, j):
+                return False
+    return True
+
+
+def is_PROP1(allocation:Allocation, agents:List[Agent], values:AllocationValues=None)->bool:
+    """
+    Check if the allocation is proportional up to one item:
+    each agent would get at least 1/n of its total value if it received one additional item from another bundle.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':1, 'y':2, 'z':6}, "Alice")
+    >>> is_PROP1([{'x'}, {'y','z'}], [Alice, Alice])
+    True
+    >>> is_PROP1([set(), {'x','y','z'}], [Alice, Alice])
+    True
+    >>> Bob = AdditiveAgent({'x':1, 'y':1, 'z':1}, "Bob")
+    >>> is_PROP1([set(), {'x','y','z'}], [Bob, Bob])
+    False
+    """
+    if values is None:
+        values = AllocationValues(allocation, agents)
+    num_of_agents = len(agents)
+    for i in range(num_of_agents):
+        if values.value_with_best_item(i) * num_of_agents < values.total_value(i):
+            return False
+    return True
+
+
+def is_MMS(allocation:Allocation, agents:List[Agent], is_feasible:Callable[[Bundle,Item], bool]=everything_is_feasible, approximation:float=1, values:AllocationValues=None)->bool:
+    """
+    Check if each agent receives at least the given fraction of its maximin share,
+    computed over all allocated items by maximin_share (so all agents must be additive).
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'x':1, 'y':2, 'z':3}, "Alice")
+    >>> is_MMS([{'x','y'}, {'z'}], [Alice, Alice])
+    True
+    >>> is_MMS([{'x'}, {'y','z'}], [Alice, Alice])
+    False
+    >>> is_MMS([{'x'}, {'y','z'}], [Alice, Alice], approximation=1/3)
+    True
+    """
+    if values is None:
+        values = AllocationValues(allocation, agents)
+    num_of_agents = len(agents)
+    for i,agent in enumerate(agents):
+        share = maximin_share(agent, values.all_items, num_of_agents, is_feasible)
+        if values.bundle_values[i][i] < approximation * share:
+            return False
+    return True
+
+
+def maximin_share(agent:Agent, items:Bundle, num_of_parts:int, is_feasible:Callable[[Bundle,Item], bool]=everything_is_feasible)->float:
+    """
+    Calculate the maximin share of the given agent: the largest value it can guarantee
+    by partitioning the items into num_of_parts feasible bundles and getting the worst one.
+    Items may be left unallocated; for monotone valuations this changes nothing when there are no constraints.
+    The capacities of an AdditiveAgentWithCapacity or AdditiveAgentWithCategoryCapacities are added to the constraint,
+    so the additive item values can be used.
+    The calculation uses branch-and-bound, and its result is cached per valuation, so agents with the same values share it.
+
+    :param agent: an AdditiveAgent (or a subclass with capacities); other agents raise a ValueError,
+           since the branch-and-bound relies on additive item values.
+    :param is_feasible: a downwards-closed feasibility constraint, as in allocations.feasible_allocations.
+           It can also be a declarative Constraint from feasibility.py.
+
+    >>> from agents import AdditiveAgent
+    >>> Alice = AdditiveAgent({'a':1, 'b':2, 'c':3, 'd':4, 'e':5, 'f':6})
+    >>> maximin_share(Alice, Alice.all_items(), 2)
+    10
+    >>> maximin_share(Alice, Alice.all_items(), 3)
+    7
+    >>> from feasibility import Cardinality
+    >>> maximin_share(Alice, Alice.all_items(), 3, Cardinality(1))
+    4
+    >>> Bob = AdditiveAgentWithCapacity(1, {'a':1, 'b':2, 'c':3, 'd':4, 'e':5, 'f':6})
+    >>> maximin_share(Bob, Bob.all_items(), 3)
+    4
+    >>> from cycle_free_allocations import no_cycles
+    >>> triangle = [('x','y'),('y','z'),('z','x')]
+    >>> maximin_share(AdditiveAgent({edge:1 for edge in triangle}), triangle, 1, no_cycles)
+    2
+    """
+    if not isinstance(agent, AdditiveAgent):
+        raise ValueError("maximin_share supports only additive agents, but {} is a {}".format(agent.name(), type(agent).__name__))
+    item_values = tuple(sorted([(item, agent.item_value(item)) for item in items], key=lambda pair: repr(pair[0])))
+    return _maximin_share(item_values, num_of_parts, is_feasible, _capacities_of(agent))
+
+
+def _capacities_of(agent:Agent)->Optional[Tuple]:
+    """
+    A hashable description of the capacities of the agent: (k, None) for a single capacity,
+    (None, ((capacity, items), ...)) for category capacities, or None.
+    """
+    if isinstance(agent, AdditiveAgentWithCapacity):
+        return (agent.capacity, None)
+    if isinstance(agent, AdditiveAgentWithCategoryCapacities):
+        return (None, tuple([(capacity, tuple(values.keys())) for (capacity, values) in agent.categories]))
+    return None
+
+
+@lru_cache(maxsize=1024)
+def _maximin_share(item_values:Tuple[Tuple[Item,float],...], num_of_parts:int, is_feasible:Callable[[Bundle,Item], bool], capacities:Optional[Tuple])->float:
+    item_values = sorted([pair for pair in item_values if pair[1] > 0], key=lambda pair: -pair[1])
+    items = [item for (item,_) in item_values]
+    values = [value for (_,value) in item_values]
+    num_of_items = len(items)
+    if num_of_parts<=0 or num_of_items==0:
+        return 0
+
+    # Declarative constraints (including the capacities) are compiled to bitmask states;
+    # other feasibility functions are called with the bundle as a set.
+    constraint = None
+    if capacities is not None:
+        (k, categories) = capacities
+        constraint = Cardinality(k) if k is not None else CategoryCapacities(categories)
+    other_constraint = None
+    if isinstance(is_feasible, Constraint):
+        constraint = is_feasible if constraint is None else constraint & is_feasible
+    elif is_feasible is not everything_is_feasible:
+        other_constraint = is_feasible
+    is_constrained = constraint is not None or other_constraint is not None
+    compiled = (constraint if constraint is not None else AllOf()).compile(items)
+    if other_constraint is None:
+        initial_state = compiled.initial_state()
+        can_add = compiled.can_add
+        add = compiled.add
+    else:
+        initial_state = (compiled.initial_state(), frozenset())
+        def can_add(state, item_index):
+            return compiled.can_add(state[0], item_index) and other_constraint(set(state[1]), items[item_index])
+        def add(state, item_index):
+            return (compiled.add(state[0], item_index), state[1] | {items[item_index]})
+
+    remaining = [0]*(num_of_items+1)   # remaining[k] = total value of items k, k+1, ...
+    for k in range(num_of_items-1, -1, -1):
+        remaining[k] = remaining[k+1] + values[k]
+    if all([isinstance(value, int) for value in values]):
+        upper_bound = remaining[0] // num_of_parts
+    else:
+        upper_bound = remaining[0] / num_of_parts
+
+    # Initial lower bound: greedily give each item to the poorest bundle that can take it.
+    bundle_values = [0]*num_of_parts
+    states = [initial_state]*num_of_parts
+    for k in range(num_of_items):
+        for i in sorted(range(num_of_parts), key=lambda i: bundle_values[i]):
+            if can_add(states[i], k):
+                states[i] = add(states[i], k)
+                bundle_values[i] += values[k]
+                break
+    best = min(bundle_values)
+
+    def search(k:int, bundle_values:List[float], states:List):
+        nonlocal best
+        if best >= upper_bound:
+            return
+        if k==num_of_items:
+            best = max(best, min(bundle_values))
+            return
+        deficit = sum([best - value for value in bundle_values if value < best])
+        if deficit >= remaining[k]:
+            return      # even the remaining items cannot raise all bundles above best.
+        tried = set()
+        for i in sorted(range(num_of_parts), key=lambda i: bundle_values[i]):
+            symmetry_key = states[i] if is_constrained else bundle_values[i]
+            if symmetry_key in tried or not can_add(states[i], k):
+                continue
+            tried.add(symmetry_key)
+            new_values = list(bundle_values)
+            new_values[i] += values[k]
+            new_states = list(states)
+            new_states[i] = add(states[i], k)
+            search(k+1, new_values, new_states)
+        if is_constrained:
+            search(k+1, bundle_values, states)    # leave the item unallocated
+
+    search(0, [0]*num_of_parts, [initial_state]*num_of_parts)
+    return best
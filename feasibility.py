@@ -2,11 +2,15 @@
 Defines several common feasibility constraints on bundles.
 Note that a feasibility-checker receives a bundle and an item,
 and returns True iff adding the item to the bundle results in a feasible bundle.
+Also defines declarative constraints (Cardinality, CategoryCapacities, Conflicts, Budget and their conjunctions),
+which are compiled into bitmask checks.
 
 Author: Erel Segal-Halevi
 Since:  2020-04
 """
 
+import numpy as np
+from abc import ABC, abstractmethod
 
 from typing import *
 Item = Any
@@ -21,3 +25,284 @@ def at_most_1_item_per_agent(bundle:Bundle, new_item:Item)->bool:
 
 def at_most_3_items_per_agent(bundle:Bundle, new_item:Item)->bool:
     return len(bundle)<=2
+
+
+
+##### DECLARATIVE CONSTRAINTS #####
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+    def _popcount(x:int)->int:
+        return bin(x).count("1")
+
+
+class Constraint(ABC):
+    """
+    A declarative, downwards-closed feasibility constraint.
+    Before use, it is compiled for a specific list of items into a CompiledConstraint,
+    in which each bundle is represented by a state: a tuple (bitmask of items, load of budget 1, load of budget 2, ...).
+    Constraints can be combined with &.
+    A Constraint can also be used directly as an is_feasible function, but this compiles it on every call.
+    AllocationEnumerator and IncrementalAllocation compile it once; other callers should call compile()
+    once and pass the CompiledConstraint.
+
+    >>> c = Cardinality(2) & Conflicts([('x','y')])
+    >>> c
+    Cardinality(2) & Conflicts([('x', 'y')])
+    >>> c({'x'}, 'y')
+    False
+    >>> c({'x'}, 'z')
+    True
+    >>> c({'x','z'}, 'w')
+    False
+    """
+
+    def compile(self, items:List[Item])->"CompiledConstraint":
+        compiled = CompiledConstraint(items)
+        self.contribute(compiled)
+        return compiled
+
+    @abstractmethod
+    def contribute(self, compiled:"CompiledConstraint"):
+        """
+        Add the masks and counters of this constraint to the given compiled constraint.
+        """
+        pass
+
+    def __and__(self, other:"Constraint")->"Constraint":
+        return AllOf(self, other)
+
+    def __call__(self, bundle:Bundle, new_item:Item)->bool:
+        return self.compile(list(bundle)+[new_item])(bundle, new_item)
+
+
+class Cardinality(Constraint):
+    """
+    A bundle may contain at most k items.
+    """
+
+    def __init__(self, k:int):
+        self.k = k
+
+    def contribute(self, compiled:"CompiledConstraint"):
+        if compiled.max_items is None or self.k < compiled.max_items:
+            compiled.max_items = self.k
+
+    def __repr__(self):
+        return "Cardinality({})".format(self.k)
+
+
+class CategoryCapacities(Constraint):
+    """
+    Each category has a capacity - a bundle may contain at most this number of items from the category.
+    The categories are given as in AdditiveAgentWithCategoryCapacities: a list of (capacity, items) tuples,
+    where items can also be a dict from items to values.
+
+    >>> c = CategoryCapacities([(1, ['ax','ay']), (2, {'bx':5, 'by':6, 'bz':7})])
+    >>> c({'ax','bx'}, 'ay')
+    False
+    >>> c({'ax','bx'}, 'by')
+    True
+    >>> c({'ax','bx','by'}, 'bz')
+    False
+    """
+
+    def __init__(self, categories:List[Tuple[int,Iterable[Item]]]):
+        self.categories = [(capacity, list(items)) for (capacity,items) in categories]
+
+    def contribute(self, compiled:"CompiledConstraint"):
+        for (capacity, items) in self.categories:
+            category_mask = compiled.mask(items)
+            for item_index in compiled.indices(items):
+                compiled.item_categories[item_index].append((category_mask, capacity))
+
+    def __repr__(self):
+        return "CategoryCapacities({})".format(self.categories)
+
+
+class Conflicts(Constraint):
+    """
+    A conflict graph: a bundle may not contain both endpoints of any edge.
+    The edges can be given as a list of pairs, or as the edges of a networkx graph.
+    """
+
+    def __init__(self, edges:Iterable[Tuple[Item,Item]]):
+        self.edges = [tuple(edge) for edge in edges]
+
+    def contribute(self, compiled:"CompiledConstraint"):
+        for (u,v) in self.edges:
+            if u in compiled.index and v in compiled.index:
+                compiled.conflicts[compiled.index[u]] |= compiled.bits[compiled.index[v]]
+                compiled.conflicts[compiled.index[v]] |= compiled.bits[compiled.index[u]]
+
+    def __repr__(self):
+        return "Conflicts({})".format(self.edges)
+
+
+class Budget(Constraint):
+    """
+    A knapsack constraint: the total weight of a bundle may be at most the capacity.
+    Items with no given weight have weight 0.
+
+    >>> c = Budget(10, {'x':6, 'y':5, 'z':4})
+    >>> c({'x'}, 'y')
+    False
+    >>> c({'x'}, 'z')
+    True
+    """
+
+    def __init__(self, capacity:float, weights:Dict[Item,float]):
+        self.capacity = capacity
+        self.weights = dict(weights)
+
+    def contribute(self, compiled:"CompiledConstraint"):
+        compiled.budgets.append(([self.weights.get(item,0) for item in compiled.items], self.capacity))
+
+    def __repr__(self):
+        return "Budget({}, {})".format(self.capacity, self.weights)
+
+
+class AllOf(Constraint):
+    """
+    A conjunction of constraints: a bundle is feasible iff it is feasible for all of them.
+    """
+
+    def __init__(self, *constraints:Constraint):
+        self.constraints = []
+        for constraint in constraints:
+            if isinstance(constraint, AllOf):
+                self.constraints += constraint.constraints
+            else:
+                self.constraints.append(constraint)
+
+    def contribute(self, compiled:"CompiledConstraint"):
+        for constraint in self.constraints:
+            constraint.contribute(compiled)
+
+    def __repr__(self):
+        return " & ".join([repr(constraint) for constraint in self.constraints])
+
+
+BundleState = Tuple   # (bitmask, load of budget 1, load of budget 2, ...)
+
+class CompiledConstraint:
+    """
+    A constraint compiled for a specific list of items.
+    Adding an item to a bundle is checked using a few integer operations on the bundle state.
+
+    >>> c = (Cardinality(3) & CategoryCapacities([(1, ['ax','ay'])]) & Conflicts([('x','y')]) & Budget(10, {'x':6, 'z':5})).compile(['ax','ay','x','y','z'])
+    >>> s = c.initial_state()
+    >>> c.can_add(s, c.index['ax'])
+    True
+    >>> s = c.add(s, c.index['ax'])
+    >>> c.can_add(s, c.index['ay'])
+    False
+    >>> s = c.add(s, c.index['x'])
+    >>> c.can_add(s, c.index['y']), c.can_add(s, c.index['z'])
+    (False, False)
+    >>> c.can_add(c.remove(s, c.index['x']), c.index['z'])
+    True
+    >>> c.items_of(s)
+    ['ax', 'x']
+    >>> c.are_feasible([{'ax','x'}, {'ax','ay'}, {'x','y'}, {'x','z'}, {'ax','y','z'}, {'ax','x','y','z'}]).tolist()
+    [True, False, False, False, True, False]
+    >>> c({'ax','y'}, 'z')
+    True
+    """
+
+    def __init__(self, items:List[Item]):
+        self.items = list(items)
+        self.index = {item:i for i,item in enumerate(self.items)}
+        self.bits = [1<<i for i in range(len(self.items))]
+        self.max_items = None
+        self.item_categories = [[] for _ in self.items]   # for each item: a list of (category mask, capacity)
+        self.conflicts = [0 for _ in self.items]          # for each item: a mask of the items that conflict with it
+        self.budgets = []                                 # a list of (weight of each item, capacity)
+
+    def mask(self, items:Iterable[Item])->int:
+        result = 0
+        for item in items:
+            if item in self.index:
+                result |= self.bits[self.index[item]]
+        return result
+
+    def indices(self, items:Iterable[Item])->List[int]:
+        return [self.index[item] for item in items if item in self.index]
+
+    def items_of(self, state:BundleState)->List[Item]:
+        mask = state[0]
+        return [item for item,bit in zip(self.items,self.bits) if mask & bit]
+
+    def initial_state(self)->BundleState:
+        """
+        The state of the empty bundle.
+        """
+        return (0,) + (0,)*len(self.budgets)
+
+    def state_of(self, bundle:Bundle)->BundleState:
+        indices = self.indices(bundle)
+        return (self.mask(bundle),) + tuple([sum([weights[i] for i in indices]) for (weights,_) in self.budgets])
+
+    def can_add(self, state:BundleState, item_index:int)->bool:
+        """
+        Return True iff the bundle with the given state remains feasible when the given item is added to it.
+        """
+        mask = state[0]
+        if mask & self.conflicts[item_index]:
+            return False
+        if self.max_items is not None and _popcount(mask) >= self.max_items:
+            return False
+        for (category_mask, capacity) in self.item_categories[item_index]:
+            if _popcount(mask & category_mask) >= capacity:
+                return False
+        for (budget_index, (weights, capacity)) in enumerate(self.budgets):
+            if state[budget_index+1] + weights[item_index] > capacity:
+                return False
+        return True
+
+    def add(self, state:BundleState, item_index:int)->BundleState:
+        """
+        Return the state of the bundle after the given item is added to it.
+        """
+        return (state[0] | self.bits[item_index],) + tuple([
+            load + weights[item_index] for (load, (weights,_)) in zip(state[1:], self.budgets)])
+
+    def remove(self, state:BundleState, item_index:int)->BundleState:
+        """
+        Return the state of the bundle after the given item (which must be in the bundle) is removed from it.
+        """
+        return (state[0] & ~self.bits[item_index],) + tuple([
+            load - weights[item_index] for (load, (weights,_)) in zip(state[1:], self.budgets)])
+
+    def __call__(self, bundle:Bundle, new_item:Item)->bool:
+        """
+        Check a bundle given as a set. This takes time linear in the bundle size; callers that keep
+        the bundle states (initial_state/add/remove) need only can_add.
+        """
+        return self.can_add(self.state_of(bundle), self.index[new_item])
+
+    def are_feasible(self, bundles:Iterable[Bundle])->np.ndarray:
+        """
+        Check many whole bundles at once.
+        :return: a boolean array with one entry per bundle.
+        """
+        bundles = list(bundles)
+        num_of_items = len(self.items)
+        membership = np.zeros((len(bundles), num_of_items), dtype=bool)
+        for bundle_index,bundle in enumerate(bundles):
+            membership[bundle_index, self.indices(bundle)] = True
+        feasible = np.ones(len(bundles), dtype=bool)
+        if self.max_items is not None:
+            feasible &= membership.sum(axis=1) <= self.max_items
+        categories = {category for item_categories in self.item_categories for category in item_categories}
+        for (category_mask, capacity) in categories:
+            category_members = np.array([bool(category_mask & bit) for bit in self.bits], dtype=bool)
+            feasible &= membership[:, category_members].sum(axis=1) <= capacity
+        for item_index in range(num_of_items):
+            if self.conflicts[item_index]:
+                conflicting = np.array([bool(self.conflicts[item_index] & bit) for bit in self.bits], dtype=bool)
+                feasible &= ~(membership[:, item_index] & membership[:, conflicting].any(axis=1))
+        for (weights, capacity) in self.budgets:
+            feasible &= membership @ np.array(weights, dtype=float) <= capacity
+        return feasible